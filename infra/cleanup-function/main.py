@@ -8,190 +8,380 @@ Stop = Create snapshot + Delete instance (saves money, preserves data)
 """
 
 import os
-import json
-from datetime import datetime, timezone, timedelta
+import re
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import google.auth
+from google.api_core import exceptions as api_exceptions
+from google.api_core import retry
 from google.cloud import compute_v1
 import functions_framework
+import orjson
 
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "teable-666")
-ZONE = os.environ.get("GCP_ZONE", "asia-east2-a")
 IDLE_TIMEOUT_HOURS = int(os.environ.get("IDLE_TIMEOUT_HOURS", "12"))
+IDLE_TIMEOUT_SECONDS = IDLE_TIMEOUT_HOURS * 3600
+# Max environments stopped in parallel (kept low to stay under snapshot quotas).
+# google-cloud-compute only ships sync (REST) clients, so this is a thread pool.
+CLEANUP_CONCURRENCY = int(os.environ.get("CLEANUP_CONCURRENCY", "5"))
+# Max seconds to wait for a single GCE operation to finish
+OPERATION_TIMEOUT_SECONDS = 600
+# Max times a mutation is sent when its operation fails with a transient error
+OPERATION_ATTEMPTS = 5
 
+# Characters not allowed in GCP resource names / label values
+SANITIZE_PATTERN = re.compile(r"[^a-z0-9-]")
 
+# Transient errors (rate limits and temporary unavailability)
+TRANSIENT_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.TooManyRequests,
+)
+
+# Retry requests on transient errors with exponential backoff and jitter;
+# other errors are raised immediately
+OPERATION_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(*TRANSIENT_ERRORS),
+    initial=1.0,
+    maximum=30.0,
+    multiplier=2.0,
+    timeout=120.0,
+)
+
+
+@functools.lru_cache(maxsize=1)
+def get_credentials():
+    """Get default credentials, shared by all clients so tokens are reused."""
+    credentials, _ = google.auth.default()
+    return credentials
+
+
+@functools.lru_cache(maxsize=1)
 def get_instances_client():
-    return compute_v1.InstancesClient()
+    return compute_v1.InstancesClient(credentials=get_credentials())
 
 
+@functools.lru_cache(maxsize=1)
 def get_snapshots_client():
-    return compute_v1.SnapshotsClient()
+    return compute_v1.SnapshotsClient(credentials=get_credentials())
+
+
+@functools.lru_cache(maxsize=1)
+def get_zone_operations_client():
+    return compute_v1.ZoneOperationsClient(credentials=get_credentials())
+
+
+@functools.lru_cache(maxsize=1)
+def get_global_operations_client():
+    return compute_v1.GlobalOperationsClient(credentials=get_credentials())
 
 
 def get_dev_environments():
-    """List all dev environment instances."""
+    """
+    List all dev environment instances across all zones.
+    
+    Idleness is decided from metadata in Python rather than a server-side
+    filter: last-active-at is only written as metadata (labels can't be set
+    from the VM's metadata server), and kept instances are still reported.
+    """
     client = get_instances_client()
     
-    request = compute_v1.ListInstancesRequest(
+    request = compute_v1.AggregatedListInstancesRequest(
         project=PROJECT_ID,
-        zone=ZONE,
         filter='labels.purpose="dev-env"',
     )
     
-    instances = []
-    for instance in client.list(request=request):
-        instances.append(instance)
+    # A single aggregated list covers every zone; instances are streamed
+    # rather than collected so only one page is held in memory at a time
+    for _, scoped_list in client.aggregated_list(request=request):
+        yield from scoped_list.instances
+
+
+def get_existing_snapshot_names():
+    """Get the names of all existing dev environment snapshots."""
+    client = get_snapshots_client()
+    
+    request = compute_v1.ListSnapshotsRequest(
+        project=PROJECT_ID,
+        filter='labels.purpose="dev-env-snapshot"',
+    )
     
-    return instances
+    return {snapshot.name for snapshot in client.list(request=request)}
+
 
+def get_zone_name(zone_url):
+    """Get the zone name (e.g. asia-east2-a) from a zone URL."""
+    return zone_url.rsplit("/", 1)[-1]
 
-def get_metadata_value(instance, key):
-    """Get a metadata value from an instance."""
+
+def get_metadata_dict(instance):
+    """Get all metadata items of an instance as a dict."""
     if not instance.metadata or not instance.metadata.items:
-        return None
+        return {}
     
-    for item in instance.metadata.items:
-        if item.key == key:
-            return item.value
-    return None
+    return {item.key: item.value for item in instance.metadata.items}
+
 
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp, accepting a trailing 'Z' for UTC."""
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value)
 
-def should_delete_instance(instance):
+
+def get_age_seconds(value, now_ts):
+    """Get the number of seconds elapsed since an ISO 8601 timestamp."""
+    return now_ts - parse_timestamp(value).timestamp()
+
+
+def should_delete_instance(metadata, now_ts):
     """
-    Determine if an instance should be deleted based on last activity.
+    Determine if an instance should be deleted based on its metadata.
     
     An instance should be deleted if:
     - It has been more than IDLE_TIMEOUT_HOURS since last-active-at
     - OR if last-active-at is not set and created-at is old enough
-    """
-    now = datetime.now(timezone.utc)
     
+    now_ts is the current time as epoch seconds, read once per cleanup run.
+    Returns (should_delete, reason, idle_seconds); idle_seconds is only set
+    when should_delete is True.
+    """
     # Get last active time
-    last_active_str = get_metadata_value(instance, "last-active-at")
-    created_at_str = get_metadata_value(instance, "created-at")
+    last_active_str = metadata.get("last-active-at")
+    created_at_str = metadata.get("created-at")
     
     if last_active_str:
         try:
-            last_active = datetime.fromisoformat(last_active_str.replace("Z", "+00:00"))
-            idle_time = now - last_active
-            if idle_time > timedelta(hours=IDLE_TIMEOUT_HOURS):
-                return True, f"Idle for {idle_time.total_seconds() / 3600:.1f} hours"
+            idle_seconds = get_age_seconds(last_active_str, now_ts)
+            if idle_seconds > IDLE_TIMEOUT_SECONDS:
+                return True, f"Idle for {idle_seconds / 3600:.1f} hours", idle_seconds
         except ValueError:
             pass
     
     # Fallback to created-at if last-active-at is not available
-    if created_at_str:
+    if created_at_str and not last_active_str:
         try:
-            created_at = datetime.fromisoformat(created_at_str.replace("Z", "+00:00"))
-            age = now - created_at
+            age_seconds = get_age_seconds(created_at_str, now_ts)
             # If no activity tracking and older than timeout, delete
-            if not last_active_str and age > timedelta(hours=IDLE_TIMEOUT_HOURS):
-                return True, f"No activity tracking, age: {age.total_seconds() / 3600:.1f} hours"
+            if age_seconds > IDLE_TIMEOUT_SECONDS:
+                return True, f"No activity tracking, age: {age_seconds / 3600:.1f} hours", age_seconds
         except ValueError:
             pass
     
-    return False, "Still active"
+    return False, "Still active", None
+
+
+def run_operation(method, **kwargs):
+    """
+    Call a compute API method and wait for its operation to complete.
+    
+    The request and each wait call are retried on their own on transient
+    errors. The mutation is only sent again once its operation has finished
+    with a transient (quota) error, never while it may still be running.
+    """
+    delays = retry.exponential_sleep_generator(1.0, 30.0)
+    
+    for attempt in range(OPERATION_ATTEMPTS):
+        operation = method(retry=OPERATION_RETRY, **kwargs)
+        result = wait_for_operation(operation.name, get_zone_name(operation.zone))
+        if not result.error:
+            return result
+        
+        error = api_exceptions.from_http_status(
+            result.http_error_status_code,
+            f"Operation {operation.name} failed: {result.error}",
+        )
+        if not isinstance(error, TRANSIENT_ERRORS) or attempt == OPERATION_ATTEMPTS - 1:
+            raise error
+        
+        delay = next(delays)
+        print(f"  Retrying in {delay:.1f}s after transient error: {error}")
+        time.sleep(delay)
+
+
+def wait_for_operation(operation_name, zone=None):
+    """
+    Wait for a zone (or global, if no zone) operation to complete.
+    
+    Uses the operations wait API, which blocks server-side for up to
+    2 minutes per call, so no client-side sleeps are needed. Each call is
+    limited to the remaining time so OPERATION_TIMEOUT_SECONDS is not overshot.
+    Returns the finished operation; callers check its error.
+    """
+    deadline = time.monotonic() + OPERATION_TIMEOUT_SECONDS
+    
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Operation {operation_name} timed out")
+        
+        # wait is idempotent, so it is safe to retry on its own
+        if zone:
+            result = get_zone_operations_client().wait(
+                project=PROJECT_ID,
+                zone=zone,
+                operation=operation_name,
+                retry=OPERATION_RETRY,
+                timeout=remaining,
+            )
+        else:
+            result = get_global_operations_client().wait(
+                project=PROJECT_ID,
+                operation=operation_name,
+                retry=OPERATION_RETRY,
+                timeout=remaining,
+            )
+        
+        if result.status == compute_v1.Operation.Status.DONE:
+            return result
+
+
+def sanitize_username(username):
+    """Sanitize a username for use in GCP resource names and labels."""
+    return SANITIZE_PATTERN.sub("-", username.lower())
+
+
+def delete_instance(instances_client, instance_name, zone):
+    """Delete an instance and wait for the deletion to complete."""
+    print(f"  Deleting instance {instance_name}...")
+    run_operation(
+        instances_client.delete,
+        project=PROJECT_ID,
+        zone=zone,
+        instance=instance_name,
+    )
+    print(f"  Instance {instance_name} deleted")
+    return True
+
+
+def delete_snapshot(snapshots_client, snapshot_name):
+    """Delete a snapshot, ignoring it if it doesn't exist."""
+    try:
+        print(f"  Deleting old snapshot {snapshot_name}...")
+        # Housekeeping only, so don't block long on the request itself
+        run_operation(
+            snapshots_client.delete,
+            project=PROJECT_ID,
+            snapshot=snapshot_name,
+            timeout=10.0,
+        )
+    except Exception as e:
+        # Ignore if snapshot doesn't exist
+        if "404" not in str(e) and "NOT_FOUND" not in str(e):
+            print(f"  Warning: Error deleting old snapshot: {e}")
 
 
-def get_snapshot_name(username):
-    """Get snapshot name for a user."""
-    sanitized = username.lower().replace("@", "-").replace(".", "-")
-    sanitized = ''.join(c if c.isalnum() or c == '-' else '-' for c in sanitized)
-    return f"dev-snapshot-{sanitized}"
+def is_snapshot_current(snapshots_client, snapshot_name, source_disk, last_active_str):
+    """
+    Check if a READY snapshot of the disk was taken after the last activity.
+    
+    This happens when a previous run created the snapshot but failed to
+    delete the instance; re-snapshotting would only burn quota.
+    """
+    if not last_active_str:
+        return False
+    
+    try:
+        snapshot = snapshots_client.get(
+            project=PROJECT_ID,
+            snapshot=snapshot_name,
+        )
+    except api_exceptions.NotFound:
+        return False
+    except api_exceptions.GoogleAPICallError as e:
+        # Optional check: fall back to re-snapshotting rather than failing
+        print(f"  Warning: Error checking snapshot {snapshot_name}: {e}")
+        return False
+    
+    if snapshot.status != "READY" or not snapshot.source_disk.endswith(source_disk):
+        return False
+    
+    try:
+        created_at = parse_timestamp(snapshot.creation_timestamp)
+        last_active = parse_timestamp(last_active_str)
+    except ValueError:
+        return False
+    
+    return created_at > last_active
 
 
-def stop_instance(instance_name, username):
+def stop_instance(instance_name, zone, username, last_active_str=None, existing_snapshots=None):
     """
     Stop an instance by creating a snapshot and then deleting the instance.
     This preserves user data while reducing costs.
+    
+    existing_snapshots, if given, is the set of snapshot names known to exist;
+    lookups and deletes of snapshots not in it are skipped.
     """
     instances_client = get_instances_client()
     snapshots_client = get_snapshots_client()
-    snapshot_name = get_snapshot_name(username)
+    sanitized_username = sanitize_username(username)
+    snapshot_name = f"dev-snapshot-{sanitized_username}"
+    source_disk = f"projects/{PROJECT_ID}/zones/{zone}/disks/{instance_name}"
+    has_snapshot = existing_snapshots is None or snapshot_name in existing_snapshots
     
+    # These steps must stay sequential: the old and new snapshot share the
+    # same name, and the instance (with its boot disk) can only be deleted
+    # once the new snapshot is ready.
     try:
+        if has_snapshot and is_snapshot_current(snapshots_client, snapshot_name, source_disk, last_active_str):
+            print(f"  Snapshot {snapshot_name} is newer than last activity, skipping")
+            return delete_instance(instances_client, instance_name, zone)
+        
         # Delete old snapshot if exists
-        try:
-            print(f"  Deleting old snapshot {snapshot_name}...")
-            operation = snapshots_client.delete(
-                project=PROJECT_ID,
-                snapshot=snapshot_name,
-            )
-            wait_for_global_operation(operation.name)
-        except Exception as e:
-            # Ignore if snapshot doesn't exist
-            if "404" not in str(e) and "NOT_FOUND" not in str(e):
-                print(f"  Warning: Error deleting old snapshot: {e}")
+        if has_snapshot:
+            delete_snapshot(snapshots_client, snapshot_name)
         
         # Create new snapshot
         print(f"  Creating snapshot {snapshot_name}...")
         snapshot = compute_v1.Snapshot()
         snapshot.name = snapshot_name
-        snapshot.source_disk = f"projects/{PROJECT_ID}/zones/{ZONE}/disks/{instance_name}"
+        snapshot.source_disk = source_disk
         snapshot.description = f"Auto-saved snapshot for {username}'s dev environment"
         snapshot.labels = {
             "purpose": "dev-env-snapshot",
-            "user": username.lower().replace("@", "-").replace(".", "-")[:63],
+            "user": sanitized_username[:63],
         }
         
-        operation = snapshots_client.insert(
-            project=PROJECT_ID,
-            snapshot_resource=snapshot,
-        )
-        wait_for_global_operation(operation.name)
+        try:
+            run_operation(
+                snapshots_client.insert,
+                project=PROJECT_ID,
+                snapshot_resource=snapshot,
+            )
+        except api_exceptions.Conflict:
+            # The snapshot exists but wasn't in existing_snapshots
+            # (e.g. missing label, or created by another instance of the user)
+            print(f"  Snapshot {snapshot_name} already exists, replacing it...")
+            delete_snapshot(snapshots_client, snapshot_name)
+            run_operation(
+                snapshots_client.insert,
+                project=PROJECT_ID,
+                snapshot_resource=snapshot,
+            )
         print(f"  Snapshot {snapshot_name} created")
         
-        # Delete the instance
-        print(f"  Deleting instance {instance_name}...")
-        operation = instances_client.delete(
-            project=PROJECT_ID,
-            zone=ZONE,
-            instance=instance_name,
-        )
-        wait_for_zone_operation(operation.name)
-        print(f"  Instance {instance_name} deleted")
-        
-        return True
+        return delete_instance(instances_client, instance_name, zone)
     except Exception as e:
         print(f"Error stopping instance {instance_name}: {e}")
         return False
 
 
-def wait_for_zone_operation(operation_name):
-    """Wait for a zone operation to complete."""
-    operations_client = compute_v1.ZoneOperationsClient()
-    
-    while True:
-        result = operations_client.get(
-            project=PROJECT_ID,
-            zone=ZONE,
-            operation=operation_name,
-        )
-        
-        if result.status == compute_v1.Operation.Status.DONE:
-            if result.error:
-                raise Exception(f"Operation failed: {result.error}")
-            return result
-        
-        import time
-        time.sleep(2)
-
-
-def wait_for_global_operation(operation_name):
-    """Wait for a global operation to complete."""
-    operations_client = compute_v1.GlobalOperationsClient()
+def stop_instances(candidates, existing_snapshots=None):
+    """
+    Stop instances one after another, returning the entries that were stopped.
     
-    while True:
-        result = operations_client.get(
-            project=PROJECT_ID,
-            operation=operation_name,
-        )
-        
-        if result.status == compute_v1.Operation.Status.DONE:
-            if result.error:
-                raise Exception(f"Operation failed: {result.error}")
-            return result
-        
-        import time
-        time.sleep(2)
+    Instances of the same user share a snapshot name, so they must never be
+    snapshotted concurrently; each such group is stopped by a single task.
+    """
+    stopped = []
+    for _, entry, zone, last_active_str in candidates:
+        if stop_instance(entry["name"], zone, entry["username"], last_active_str, existing_snapshots):
+            stopped.append(entry)
+    return stopped
 
 
 @functions_framework.http
@@ -202,38 +392,72 @@ def cleanup_handler(request):
     This is triggered by Cloud Scheduler every hour.
     Stops (snapshot + delete) idle environments instead of destroying them.
     """
-    print(f"Starting cleanup at {datetime.now(timezone.utc).isoformat()}")
-    print(f"Project: {PROJECT_ID}, Zone: {ZONE}")
+    now = datetime.now(timezone.utc)
+    now_ts = now.timestamp()
+    print(f"Starting cleanup at {now.isoformat()}")
+    print(f"Project: {PROJECT_ID}")
     print(f"Idle timeout: {IDLE_TIMEOUT_HOURS} hours")
     
-    instances = get_dev_environments()
-    print(f"Found {len(instances)} dev environment(s)")
-    
+    count = 0
+    to_stop = []
     stopped = []
     kept = []
     
-    for instance in instances:
-        should_stop, reason = should_delete_instance(instance)
-        username = get_metadata_value(instance, "username") or "unknown"
+    # First pass: classify every instance without side effects
+    for instance in get_dev_environments():
+        count += 1
+        metadata = get_metadata_dict(instance)
+        should_stop, reason, idle_seconds = should_delete_instance(metadata, now_ts)
+        username = metadata.get("username") or "unknown"
+        entry = {
+            "name": instance.name,
+            "username": username,
+            "reason": reason,
+        }
         
         if should_stop:
-            print(f"Stopping {instance.name} (user: {username}): {reason}")
-            if stop_instance(instance.name, username):
-                stopped.append({
-                    "name": instance.name,
-                    "username": username,
-                    "reason": reason,
-                })
+            last_active_str = metadata.get("last-active-at")
+            to_stop.append((idle_seconds, entry, get_zone_name(instance.zone), last_active_str))
         else:
-            print(f"Keeping {instance.name} (user: {username}): {reason}")
-            kept.append({
-                "name": instance.name,
-                "username": username,
-                "reason": reason,
-            })
+            kept.append(entry)
+    
+    print(f"Found {count} dev environment(s)")
+    
+    # Oldest first, so they get snapshot quota first when throttled
+    to_stop.sort(key=lambda candidate: candidate[0], reverse=True)
+    
+    for entry in kept:
+        print(f"Keeping {entry['name']} (user: {entry['username']}): {entry['reason']}")
+    for _, entry, _, _ in to_stop:
+        print(f"Stopping {entry['name']} (user: {entry['username']}): {entry['reason']}")
+    
+    # Second pass: stop the candidates in parallel, grouped by snapshot name
+    # (derived from the sanitized username) so each group runs sequentially
+    existing_snapshots = None
+    if to_stop:
+        try:
+            existing_snapshots = get_existing_snapshot_names()
+        except api_exceptions.GoogleAPICallError as e:
+            # Fall back to probing for each snapshot in stop_instance
+            print(f"Warning: Error listing snapshots: {e}")
+    
+    groups = {}
+    for candidate in to_stop:
+        _, entry, _, _ = candidate
+        groups.setdefault(sanitize_username(entry["username"]), []).append(candidate)
+    
+    with ThreadPoolExecutor(max_workers=CLEANUP_CONCURRENCY) as executor:
+        futures = [
+            executor.submit(stop_instances, group, existing_snapshots)
+            for group in groups.values()
+        ]
+        
+        # Collect in submission order so the report keeps the oldest-first order
+        for future in futures:
+            stopped.extend(future.result())
     
     result = {
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": now,
         "stopped": stopped,
         "kept": kept,
         "summary": f"Stopped {len(stopped)}, kept {len(kept)} environment(s)",
@@ -241,7 +465,7 @@ def cleanup_handler(request):
     
     print(f"Cleanup complete: {result['summary']}")
     
-    return json.dumps(result), 200, {"Content-Type": "application/json"}
+    return orjson.dumps(result), 200, {"Content-Type": "application/json"}
 
 
 @functions_framework.cloud_event